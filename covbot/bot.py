@@ -1,21 +1,13 @@
-from mautrix.types import EventType
 from maubot import Plugin, MessageEvent
 from maubot.matrix import parse_formatted
 from maubot.handlers import event, command
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
-import os
-import csv
-import datetime
 import asyncio
-import math
-import whoosh
 import time
+import functools
 import pycountry
 import traceback
-from whoosh.fields import Schema, TEXT
-from whoosh.index import create_in, FileIndex
-from whoosh.qparser import QueryParser
 from tabulate import tabulate
 from mautrix.types import TextMessageEventContent, MessageType
 from mautrix.client import MembershipEventDispatcher, InternalEventType
@@ -26,6 +18,8 @@ from .data import DataSource
 RATE_LIMIT_BACKOFF_SECONDS = 10
 UPDATE_INTERVAL_SECONDS = 15 * 60
 ROOM_PRUNE_INTERVAL_SECONDS = 60 * 60
+# Most homeserver requests to have in flight at once
+MAX_CONCURRENT_REQUESTS = 10
 
 # command: ( usage, description )
 HELP = {
@@ -48,6 +42,42 @@ HELP = {
     'help': ('!help', 'Get a reminder what I can do for you.'),
 }
 
+HELP_MESSAGE = 'You can message me any of these commands:\n\n' + '\n\n'.join(
+    f'{usage} - {desc}' for (usage, desc) in HELP.values())
+JOIN_MESSAGE = 'Hi, I am a bot that tracks SARS-COV-2 infection statistics for you. You can message me any of these commands:\n\n' + '\n'.join(
+    f'{usage} - {desc}' for (usage, desc) in HELP.values())
+SOURCE_MESSAGE = (
+    'I was created by Peter Roberts and MIT licensed on Github at https://github.com/pwr22/covbot.'
+    f' I fetch new data every 15 minutes from {DataSource.get_sources()}.'
+    f' Risk estimates are based on the model at https://www.desmos.com/calculator/v0zif7tflm.'
+)
+
+
+@functools.lru_cache(maxsize=1024)
+def _country_lookup(name: str):
+    """pycountry's lookup scans every country, so remember the answers."""
+    try:
+        return pycountry.countries.lookup(name)
+    except LookupError:
+        return None
+
+
+def _text_table(headers: list, rows: list) -> str:
+    """Lay out rows of strings like tabulate's presto format.
+
+    The first column is left aligned and the numbers after it right
+    aligned, missing data included.
+    """
+    widths = [max(map(len, col)) for col in zip(headers, *rows)]
+
+    def line(cells):
+        first, *rest = cells
+        return ' ' + ' | '.join([first.ljust(widths[0])] +
+                                [c.rjust(w) for c, w in zip(rest, widths[1:])])
+
+    rule = '+'.join('-' * (w + 2) for w in widths)
+    return '\n'.join([line(headers), rule] + [line(r) for r in rows])
+
 
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
@@ -55,9 +85,6 @@ class Config(BaseProxyConfig):
 
 
 class CovBot(Plugin):
-    next_update_at: datetime.datetime = None
-    _rooms_joined = {}
-
     async def _handle_rate_limit(self, api_call_wrapper):
         while True:
             try:
@@ -71,31 +98,68 @@ class CovBot(Plugin):
                 self.log.warning('%s', tb)
                 return
 
+    async def _fetch_members(self, room_id):
+        members = await self._handle_rate_limit(functools.partial(self.client.get_joined_members, room_id))
+        if members is None:
+            self.log.warning(
+                'Failed to fetch members of %s, will retry.', room_id)
+            self._unfetched.add(room_id)
+        else:
+            self._unfetched.discard(room_id)
+            self._members[room_id] = set(members)
+
     async def _prune_dead_rooms(self):
+        limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def fetch_members(r):
+            async with limit:
+                await self._fetch_members(r)
+
+        async def leave(r):
+            self.log.debug('Leaving empty room %s.', r)
+            async with limit:
+                await self._handle_rate_limit(functools.partial(self.client.leave_room, r))
+
+        # Fetch membership once, member events keep it current after that.
+        rooms = await self._handle_rate_limit(self.client.get_joined_rooms)
+        await asyncio.gather(*(fetch_members(r) for r in rooms or []))
+
         while True:
             self.log.info('Tidying up empty rooms.')
-            users = set()
-            rooms = await self._handle_rate_limit(lambda: self.client.get_joined_rooms())
+            if rooms is None:
+                self.log.warning('Failed to list my rooms, will retry.')
+                rooms = await self._handle_rate_limit(self.client.get_joined_rooms)
+                self._unfetched.update(rooms or [])
 
-            left = 0
-            for r in rooms:
-                members = await self._handle_rate_limit(lambda: self.client.get_joined_members(r))
+            # Try again for rooms whose members we couldn't get before.
+            await asyncio.gather(*(fetch_members(r) for r in list(self._unfetched)))
+            users, empty = set(), []
 
+            for r, members in self._members.items():
                 if len(members) == 1:
-                    self.log.debug('Leaving empty room %s.', r)
-                    await self._handle_rate_limit(lambda: self.client.leave_room(r))
-                    left += 1
+                    empty.append(r)
                 else:
-                    for m in members:
-                        users.add(m)
+                    users.update(members)
+
+            # Our own leave events drop them from _members, so a room we
+            # failed to leave is still tracked and tried again next time.
+            await asyncio.gather(*(leave(r) for r in empty))
 
-            self.log.debug('I am in %s rooms.', len(rooms) - left)
+            self.log.debug('I am in %s rooms.', len(self._members))
             self.log.debug('I reach %s unique users.',
                            len(users) - 1)  # ignore myself
             await asyncio.sleep(ROOM_PRUNE_INTERVAL_SECONDS)
 
     async def _update_data(self):
+        age = await self.data.load()
+        if age is not None and age < UPDATE_INTERVAL_SECONDS:
+            # Saved recently enough, fetch again only once it is due.
+            self.log.info('Using saved data from %d seconds ago.', age)
+            await asyncio.sleep(UPDATE_INTERVAL_SECONDS - age)
+
         while True:
+            # keep to the interval however long the update takes
+            next_update_at = time.monotonic() + UPDATE_INTERVAL_SECONDS
             try:
                 await self.data.update()
             except Exception:
@@ -103,7 +167,7 @@ class CovBot(Plugin):
                 self.log.warn(
                     'Failed to update data: %s.', tb)
 
-            await asyncio.sleep(UPDATE_INTERVAL_SECONDS)
+            await asyncio.sleep(max(0, next_update_at - time.monotonic()))
 
     @classmethod
     def get_config_class(cls) -> BaseProxyConfig:
@@ -115,6 +179,14 @@ class CovBot(Plugin):
         # So we can get room join events.
         self.client.add_dispatcher(MembershipEventDispatcher)
         self.data = DataSource(self.log, self.http)
+        # room id -> joined user ids, kept current by member events
+        self._members = {}
+        # rooms whose members are still to be fetched after a failure
+        self._unfetched = set()
+        # location -> (record, !cases message for it)
+        self._summaries = {}
+        # rooms already greeted, to work around duplicate joins
+        self._rooms_joined = set()
         self._data_update_task = asyncio.create_task(self._update_data())
         self._room_prune_task = asyncio.create_task(self._prune_dead_rooms())
 
@@ -123,6 +195,7 @@ class CovBot(Plugin):
         self.client.remove_dispatcher(MembershipEventDispatcher)
         self._room_prune_task.cancel()
         self._data_update_task.cancel()
+        self.data.close()
 
     def _short_location(self, location: str, length=int(12)) -> str:
         """Returns a shortened location name.
@@ -151,10 +224,9 @@ class CovBot(Plugin):
         self.log.debug('Shortening %s.', location)
 
         # Exact country case (1)
-        try:
-            return pycountry.countries.lookup(location).alpha_2
-        except LookupError:
-            pass
+        country = _country_lookup(location)
+        if country is not None:
+            return country.alpha_2
 
         # It fits already (2)
         if len(location) <= length:
@@ -164,9 +236,9 @@ class CovBot(Plugin):
         # country code (3)
         if "," in location:
             loc_parts = [s.strip() for s in location.split(",")]
-            if pycountry.countries.lookup(loc_parts[-1]):
-                loc_parts[-1] = pycountry.countries.lookup(
-                    loc_parts[-1]).alpha_2
+            country = _country_lookup(loc_parts[-1])
+            if country is not None:
+                loc_parts[-1] = country.alpha_2
             location = " ,".join(loc_parts)
 
         # If what we have is still longer, cut out the middle (4)
@@ -183,15 +255,14 @@ class CovBot(Plugin):
                                length=str("long")) -> str:
         """Build a table of locations to respond to.
 
-        Uses tabulate module to tabulate data.
+        Text tables are laid out by _text_table, html ones by tabulate.
 
         Can be:
             - tabletype: text (default) or html
             - length: long (default), short or tiny
 
         Missing data (eg PHE) is handled and replaced
-        by '---'; although this throws off tabulate's
-        auto-alignment of numerical data.
+        by '---'.
 
         Tables by default report in following columns:
             - Location
@@ -211,66 +282,53 @@ class CovBot(Plugin):
         MISSINGDATA = "---"
 
         self.log.debug('Building table for %s', data.keys())
-        columns = ["Location", "Cases"]
+        # Which columns any of the results have data for
+        has_recs = any("recoveries" in v for v in data.values())
+        has_deaths = any("deaths" in v for v in data.values())
+        # L - C - S - R - D
+        has_sick = has_recs and has_deaths
 
-        if [v for v in data.values() if "recoveries" in v]:
-            # At least one of the results has recovery data
+        columns = ["Location", "Cases"]
+        if has_sick:
+            columns.extend(["Sick", "%"])
+        if has_recs:
             columns.extend(["Recovered", "%"])
-
-        if [v for v in data.values() if "deaths" in v]:
-            # At least one of the results has deaths data
+        if has_deaths:
             columns.extend(["Deaths", "%"])
 
-        if "Recovered" in columns and "Deaths" in columns:
-            # L - C - S - R - D
-            columns.insert(2, "Sick")
-            columns.insert(3, "%")
-
         # TODO: sort by cases descending
         tabledata = []
-        for location, data in data.items():
-            rowdata = []
-            cases = data['cases']
+        for location, loc_data in data.items():
+            cases = loc_data['cases']
 
             # Location
             if length == "short":
-                rowdata.extend([self._short_location(location)])
-            else:
-                rowdata.extend([location])
+                location = self._short_location(location)
 
             # Cases
-            rowdata.extend([f'{cases:,}'])
+            rowdata = [location, f'{cases:,}']
 
             # TODO: decide if eliding % columns
-            if "recoveries" in data:
-                recs = data['recoveries']
-                per_rec = 0 if cases == 0 else \
-                    int(recs) / int(cases) * 100
-
-                rowdata.extend([f'{recs:,}', f"{per_rec:.1f}"])
-            else:
-                rowdata.extend([MISSINGDATA, MISSINGDATA])
-
-            if "deaths" in data:
-                deaths = data['deaths']
-                per_dead = 0 if cases == 0 else \
-                    int(deaths) / int(cases) * 100
-
-                rowdata.extend([f'{deaths:,}', f"{per_dead:.1f}"])
-            else:
-                rowdata.extend([MISSINGDATA, MISSINGDATA])
-
-            if "recoveries" in data and "deaths" in data:
-                sick = cases - int(data['recoveries']) - data['deaths']
-                per_sick = 100 - per_rec - per_dead
+            if has_sick:
+                if "sick" in loc_data:
+                    sick, per_sick = loc_data['sick'], loc_data['per_sick']
+                    rowdata.extend([f'{sick:,}', f"{per_sick:.1f}"])
+                else:
+                    rowdata.extend([MISSINGDATA, MISSINGDATA])
 
-                rowdata.insert(2, f'{sick:,}')
-                rowdata.insert(3, f"{per_sick:.1f}")
-            else:
-                rowdata.extend([MISSINGDATA, MISSINGDATA])
+            if has_recs:
+                if "recoveries" in loc_data:
+                    recs, per_rec = loc_data['recoveries'], loc_data['per_rec']
+                    rowdata.extend([f'{recs:,}', f"{per_rec:.1f}"])
+                else:
+                    rowdata.extend([MISSINGDATA, MISSINGDATA])
 
-            # Trim data for which there are no columns
-            rowdata = rowdata[:len(columns)]
+            if has_deaths:
+                if "deaths" in loc_data:
+                    deaths, per_dead = loc_data['deaths'], loc_data['per_dead']
+                    rowdata.extend([f'{deaths:,}', f"{per_dead:.1f}"])
+                else:
+                    rowdata.extend([MISSINGDATA, MISSINGDATA])
 
             tabledata.append(rowdata)
 
@@ -284,25 +342,19 @@ class CovBot(Plugin):
 
         # Build table
         if tabletype == "html":
-            tablefmt = "html"
+            table = tabulate(tabledata, headers=columns,
+                             tablefmt="html", floatfmt=".1f")
         else:
-            tablefmt = "presto"
-
-        table = tabulate(tabledata, headers=columns,
-                         tablefmt=tablefmt, floatfmt=".1f")
+            table = _text_table(columns, tabledata)
 
         if data:
             return table
 
     async def _respond(self, e: MessageEvent, m: str) -> None:
-        # IRC people don't like notices.
-        if '@appservice-irc:matrix.org' in await self.client.get_joined_members(e.room_id):
-            t = MessageType.TEXT
-        else:  # But matrix people do.
-            t = MessageType.NOTICE
+        t = await self._message_type(e.room_id)
 
         c = TextMessageEventContent(msgtype=t, body=m)
-        await self._handle_rate_limit(lambda: e.respond(c))
+        await self._handle_rate_limit(functools.partial(e.respond, c))
 
     async def _respond_formatted(self, e: MessageEvent, m: str) -> None:
         """Respond with formatted message in m.text matrix format,
@@ -314,11 +366,7 @@ class CovBot(Plugin):
 
         Desktop/web Riot.im does render MD/HTML in m.notice, however.
         """
-        # IRC people don't like notices.
-        if '@appservice-irc:matrix.org' in await self.client.get_joined_members(e.room_id):
-            t = MessageType.TEXT
-        else:  # But matrix people do.
-            t = MessageType.NOTICE
+        t = await self._message_type(e.room_id)
 
         c = TextMessageEventContent(
             msgtype=t, formatted_body=m, format="org.matrix.custom.html")
@@ -395,17 +443,28 @@ class CovBot(Plugin):
             return
 
         m_loc, data = matches[0]
+        # Records are replaced, never changed, so the message for the
+        # same record object is still current.
+        summary = self._summaries.get(m_loc)
+        if summary is not None and summary[0] is data:
+            s = summary[1]
+        else:
+            s = self._cases_message(m_loc, data)
+            self._summaries[m_loc] = data, s
+
+        await self._respond(
+            event,
+            s
+        )
+
+    def _cases_message(self, m_loc: str, data: dict) -> str:
         cases, last_update = data['cases'], data['last_update']
         s = f'In {m_loc} there have been a total of {cases:,} cases as of {last_update} UTC.'
 
         # some data is more detailed
-        if 'recoveries' in data and 'deaths' in data:
-            recoveries, deaths = data['recoveries'], data['deaths']
-            sick = cases - recoveries - deaths
-
-            per_rec = 0 if cases == 0 else int(recoveries) / int(cases) * 100
-            per_dead = 0 if cases == 0 else int(deaths) / int(cases) * 100
-            per_sick = 100 - per_rec - per_dead
+        if 'sick' in data:
+            recoveries, deaths, sick = data['recoveries'], data['deaths'], data['sick']
+            per_rec, per_dead, per_sick = data['per_rec'], data['per_dead'], data['per_sick']
 
             s += (
                 f' Of these {sick:,} ({per_sick:.1f}%) are still sick or may have recovered without being recorded,'
@@ -413,10 +472,7 @@ class CovBot(Plugin):
                 f' and {deaths:,} ({per_dead:.1f}%) have died.'
             )
 
-        await self._respond(
-            event,
-            s
-        )
+        return s
 
     @command.new('compare', help=HELP["compare"][1])
     @command.argument("locations", pass_raw=True, required=True)
@@ -448,8 +504,7 @@ class CovBot(Plugin):
                                     "Please provide one.")
                 return {}
 
-            m = matches.pop()  # there's only one
-            loc, data = m
+            loc, data = matches[0]  # there's only one
             results[loc] = data
 
         t = await self._locations_table(event, data=results,
@@ -461,31 +516,31 @@ class CovBot(Plugin):
     @command.new('source', help=HELP['source'][1])
     async def source_handler(self, event: MessageEvent) -> None:
         self.log.info('Responding to !source request from %s.', event.sender)
-        await self._respond(
-            event,
-            'I was created by Peter Roberts and MIT licensed on Github at https://github.com/pwr22/covbot.'
-            f' I fetch new data every 15 minutes from {self.data.get_sources()}.'
-            f' Risk estimates are based on the model at https://www.desmos.com/calculator/v0zif7tflm.'
-        )
+        await self._respond(event, SOURCE_MESSAGE)
 
     @command.new('help', help=HELP['help'][1])
     async def help_handler(self, event: MessageEvent) -> None:
         self.log.info('Responding to !help request from %s.', event.sender)
 
-        s = 'You can message me any of these commands:\n\n'
-        s += '\n\n'.join(f'{usage} - {desc}' for (usage,
-                                                  desc) in HELP.values())
-        await self._message(event.room_id, s)
+        await self._message(event.room_id, HELP_MESSAGE)
+
+    async def _message_type(self, room_id) -> MessageType:
+        members = self._members.get(room_id)
+        if members is None:  # not tracked (yet), so ask the homeserver
+            members = await self.client.get_joined_members(room_id)
 
-    async def _message(self, room_id, m: str) -> None:
         # IRC people don't like notices.
-        if '@appservice-irc:matrix.org' in await self.client.get_joined_members(room_id):
-            t = MessageType.TEXT
+        if '@appservice-irc:matrix.org' in members:
+            return MessageType.TEXT
         else:  # But matrix people do.
-            t = MessageType.NOTICE
+            return MessageType.NOTICE
 
-        c = TextMessageEventContent(msgtype=t, body=m)
-        await self._handle_rate_limit(lambda: self.client.send_message(room_id=room_id, content=c))
+    async def _send(self, room_id, c: TextMessageEventContent) -> None:
+        await self._handle_rate_limit(functools.partial(self.client.send_message, room_id=room_id, content=c))
+
+    async def _message(self, room_id, m: str) -> None:
+        t = await self._message_type(room_id)
+        await self._send(room_id, TextMessageEventContent(msgtype=t, body=m))
 
     @command.new('announce', help='Send broadcast a message to all rooms.')
     @command.argument("message", pass_raw=True, required=True)
@@ -500,31 +555,66 @@ class CovBot(Plugin):
             await self._respond(event, 'You do not have permission to !announce.')
             return None
 
-        rooms = await self._handle_rate_limit(lambda: self.client.get_joined_rooms())
+        rooms = await self._handle_rate_limit(self.client.get_joined_rooms)
         self.log.info('Sending announcement %s to all %s rooms',
                       message, len(rooms))
 
-        for r in rooms:
-            await self._message(r, message)
+        # Every room gets the same content, so build it once per type.
+        contents = {t: TextMessageEventContent(msgtype=t, body=message)
+                    for t in (MessageType.TEXT, MessageType.NOTICE)}
+        limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def send(r):
+            async with limit:
+                t = await self._message_type(r)
+                await self._send(r, contents[t])
+
+        # One room failing shouldn't stop the rest hearing about it.
+        results = await asyncio.gather(*(send(r) for r in rooms),
+                                       return_exceptions=True)
+        for r, result in zip(rooms, results):
+            if isinstance(result, Exception):
+                self.log.warning('Failed to send announcement to %s: %s',
+                                 r, result)
 
     @event.on(InternalEventType.JOIN)
     async def join_handler(self, event: InternalEventType.JOIN) -> None:
-        me = await self._handle_rate_limit(lambda: self.client.whoami())
-
         # Ignore all joins but mine.
-        if event.sender != me:
+        if event.sender != self.client.mxid:
+            if event.room_id in self._members:
+                self._members[event.room_id].add(event.state_key)
             return
 
+        # We don't know who else is here yet.
+        await self._fetch_members(event.room_id)
+
+        # work around duplicate joins
         if event.room_id in self._rooms_joined:
             self.log.warning(
                 'Duplicate join event for room %s.', event.room_id)
             return
 
-        # work around duplicate joins
-        self._rooms_joined[event.room_id] = True
+        self._rooms_joined.add(event.room_id)
         self.log.info(
             'Sending unsolicited help on join to room %s.', event.room_id)
 
-        s = 'Hi, I am a bot that tracks SARS-COV-2 infection statistics for you. You can message me any of these commands:\n\n'
-        s += '\n'.join(f'{usage} - {desc}' for (usage, desc) in HELP.values())
-        await self._message(event.room_id, s)
+        await self._message(event.room_id, JOIN_MESSAGE)
+
+    def _member_gone(self, event) -> None:
+        if event.state_key == self.client.mxid:
+            self._members.pop(event.room_id, None)
+            self._unfetched.discard(event.room_id)
+        elif event.room_id in self._members:
+            self._members[event.room_id].discard(event.state_key)
+
+    @event.on(InternalEventType.LEAVE)
+    async def leave_handler(self, event: InternalEventType.LEAVE) -> None:
+        self._member_gone(event)
+
+    @event.on(InternalEventType.KICK)
+    async def kick_handler(self, event: InternalEventType.KICK) -> None:
+        self._member_gone(event)
+
+    @event.on(InternalEventType.BAN)
+    async def ban_handler(self, event: InternalEventType.BAN) -> None:
+        self._member_gone(event)
@@ -1,18 +1,17 @@
 import os
+import sys
 import csv
+import bisect
 import datetime
 import asyncio
-import math
-import whoosh
 import time
+import itertools
+import pickle
+import tempfile
+import collections
+import concurrent.futures
+import aiohttp
 import pycountry
-from whoosh.fields import Schema, TEXT
-from whoosh.index import create_in, FileIndex
-from whoosh.qparser import QueryParser
-from tabulate import tabulate
-from mautrix.types import TextMessageEventContent, MessageType
-from mautrix.client import MembershipEventDispatcher, InternalEventType
-from mautrix.errors.request import MLimitExceeded
 
 OFFLOOP_CASES_URL = 'http://offloop.net/covid19h/unconfirmed.csv'
 OFFLOOP_GROUPS_URL = 'https://offloop.net/covid19h/groups.txt'
@@ -29,12 +28,155 @@ COUNTRY_RENAMES = {
     "U.S. Virgin Islands": "United States Virgin Islands"
 }
 
+# ISO 3166 alpha-2 and alpha-3 codes -> country names
+COUNTRY_CODES = {code: c.name for c in pycountry.countries
+                 for code in (c.alpha_2, c.alpha_3)}
+# TODO generalise.
+COUNTRY_CODES['UK'] = COUNTRY_CODES['GB']
+
+# A stalled source must not hold up the refresh forever
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+# Where the last update is saved for a quick start
+SNAPSHOT_PATH = '/var/tmp/covbot.pickle'
+# Bump whenever the published tables or records change shape
+SNAPSHOT_VERSION = 1
+
+# Most distinct queries to keep results for between refreshes
+LOOKUP_CACHE_SIZE = 1024
+
 # UK constituent countries with their nominal data update times
 UK_COUNTRIES = {"Wales": "1200 GMT", "Scotland": "1400 GMT",
                 "England": "1800 GMT", "Northern Ireland": "1400 GMT"}
 
-SCHEMA = Schema(country=TEXT(stored=True), area=TEXT(
-    stored=True), location=TEXT(stored=True))
+
+def _percent(n, cases):
+    return 0 if cases == 0 else n * 100 / cases
+
+
+def _detailed_record(cases, deaths, recoveries, last_update):
+    """Build a record with deaths and recoveries, and what follows from them."""
+    sick = cases - recoveries - deaths
+
+    return {'cases': cases, 'deaths': deaths, 'recoveries': recoveries,
+            'last_update': last_update, 'sick': sick,
+            'per_rec': _percent(recoveries, cases),
+            'per_dead': _percent(deaths, cases),
+            'per_sick': _percent(sick, cases)}
+
+
+def _sum_records(records):
+    """Add up detailed records, e.g. the country totals of a group."""
+    cases = deaths = recoveries = 0
+    last_update = None
+    for d in records:
+        cases += d['cases']
+        deaths += d['deaths']
+        recoveries += d['recoveries']
+        if last_update is None or d['last_update'] > last_update:
+            last_update = d['last_update']
+
+    return _detailed_record(cases, deaths, recoveries, last_update)
+
+
+def _location_suffixes(location):
+    l = location.lower()
+    return [(l[i:], location) for i in range(len(l))]
+
+
+class _CsvRecords:
+    """Incremental CSV parser that is fed a body one line at a time.
+
+    Lines are held back until the reader can complete a record from them, so
+    a quoted field may span lines while a stray quote inside an unquoted field
+    stays an ordinary character, exactly as csv.reader over the whole body:
+
+    >>> def parse(body):
+    ...     records = _CsvRecords()
+    ...     rows = [row for line in body.splitlines(True)
+    ...             for row in records.feed(line)]
+    ...     return rows + records.close()
+    >>> parse('h\\nab"c,1\\nd,2\\n')
+    [['h'], ['ab"c', '1'], ['d', '2']]
+    >>> parse('h\\n"a\\nb",1\\nd,2')
+    [['h'], ['a\\nb', '1'], ['d', '2']]
+    """
+
+    # Ends the held lines: the reader only returns it as a row of its own if
+    # no quoted field was left open to swallow it.
+    SENTINEL = '\\uffff'
+
+    def __init__(self, **fmtparams):
+        self.lines = iter(())
+        self.record = []
+        self.reader = csv.reader(self, **fmtparams)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
+
+    def feed(self, line):
+        """Return the rows completed by line."""
+        self.record.append(line)
+        if not line.endswith('\n'):
+            return []  # only the end of the body, left for close()
+
+        self.lines = itertools.chain(self.record, (self.SENTINEL,))
+        rows = list(self.reader)
+        if rows[-1] != [self.SENTINEL]:
+            return []  # a quoted field is still open
+
+        self.record = []
+        return rows[:-1]
+
+    def close(self):
+        """Return any rows left, running an unterminated quote to the end."""
+        self.lines = iter(self.record)
+        self.record = []
+        return list(self.reader)
+
+
+async def _csv_rows(r, **fmtparams):
+    """Parse CSV rows from a response body as it streams in."""
+    encoding = r.charset or 'utf-8'
+    records = _CsvRecords(**fmtparams)
+    async for line in r.content:
+        for row in records.feed(line.decode(encoding)):
+            yield row
+
+    for row in records.close():
+        yield row
+
+
+async def _csv_header_and_rows(r, **fmtparams):
+    """Return the header row of a streamed CSV and an iterator over the rest."""
+    rows = _csv_rows(r, **fmtparams)
+    async for header in rows:
+        return header, rows
+
+    raise ValueError(f'{r.url} returned no CSV header.')
+
+
+async def _latest_uk_rows(rows, i_date, i_country):
+    """Keep only the rows from the latest date for each UK country.
+
+    Returns {country: (date, rows)} in a single pass over rows.
+    """
+    latest = {}
+    async for row in rows:
+        if not row or row[i_country] not in UK_COUNTRIES:
+            continue
+
+        date, country = row[i_date], row[i_country]
+        seen = latest.get(country)
+        if seen is None or date > seen[0]:  # ISO dates sort as strings
+            latest[country] = date, [row]
+        elif date == seen[0]:
+            seen[1].append(row)
+
+    return latest
 
 
 class DataSource:
@@ -43,50 +185,102 @@ class DataSource:
         self.log, self.http = log, http
         self.cases = {}
         self.groups = {}
+        # lowercased country code, country or area -> matches
+        self._exact = {}
+        # location -> (country, area) and sorted (suffix, location) pairs
+        self._locations = {}
+        self._suffixes = []
+        # normalised query -> matches, LRU, reset whenever the data changes
+        self._lookups = collections.OrderedDict()
+        # url -> conditional request headers / result of the last full fetch
+        self._validators = {}
+        self._fetched = {}
+        # what each source gave for the published data
+        self._sources = None
+        # one thread so overlapping refreshes queue rather than fan out
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='covbot-index')
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def _cached_fetch(self, url, parse):
+        """Fetch url and return what parse makes of the response.
+
+        The result is kept along with the response's validators. When the
+        next fetch gets a 304 the kept result is returned without parsing.
+        """
+        self.log.debug("Fetching %s.", url)
+        async with self.http.get(url, headers=self._validators.get(url), timeout=FETCH_TIMEOUT) as r:
+            if r.status == 304:
+                self.log.debug("%s is unchanged.", url)
+                return self._fetched[url]
 
-    async def _get_offloop_groups(self):
-        groups = {}
+            r.raise_for_status()
+            result = await parse(r)
 
-        self.log.debug("Fetching %s.", OFFLOOP_GROUPS_URL)
-        async with self.http.get(OFFLOOP_GROUPS_URL) as r:
-            t = await r.text()
+        headers = {}
+        if 'ETag' in r.headers:
+            headers['If-None-Match'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            headers['If-Modified-Since'] = r.headers['Last-Modified']
 
+        self._validators[url], self._fetched[url] = headers, result
+        return result
+
+    async def _get_offloop_groups(self):
+        async def parse(r):
+            groups = {}
             # group;country_1;country_2 ...
-            cr = csv.reader(t.splitlines(), delimiter=';')
-            for group, *areas in cr:
+            async for row in _csv_rows(r, delimiter=';'):
+                if not row:  # skip blank lines
+                    continue
+
+                group, *areas = row
                 groups[group] = areas
 
-        return groups
+            return groups
+
+        # Groups are extra, so failing to get them mustn't stop the
+        # case data updating.
+        try:
+            return await self._cached_fetch(OFFLOOP_GROUPS_URL, parse)
+        except Exception:
+            self.log.warning('Failed to fetch %s, keeping the last groups.',
+                             OFFLOOP_GROUPS_URL, exc_info=True)
+            return self._fetched.get(OFFLOOP_GROUPS_URL, {})
 
     async def _get_nhs(self):
-        regions = {}
+        async def parse(r):
+            regions = {}
+            # GSS_CD, NHSRNm, TotalCases
+            header, cr = await _csv_header_and_rows(r)
+            i_name, i_cases = header.index('NHSRNm'), header.index('TotalCases')
+            async for row in cr:
+                if not row:  # skip blank lines
+                    continue
 
-        self.log.debug("Fetching %s.", NHS_URL)
-        async with self.http.get(NHS_URL) as r:
-            t = await r.text()
-            l = t.splitlines()
+                regions[row[i_name]] = int(row[i_cases].replace(',', ''))
 
-        # GSS_CD, NHSRNm, TotalCases
-        cr = csv.DictReader(l)
-        for row in cr:
-            regions[row['NHSRNm']] = int(row['TotalCases'].replace(',', ''))
+            return regions
 
-        return regions
+        return await self._cached_fetch(NHS_URL, parse)
 
     async def _get_uk(self):
-        regions = {}
+        async def parse(r):
+            regions = {}
+            # GSS_CD, GSS_NM, TotalCases
+            header, cr = await _csv_header_and_rows(r)
+            i_name, i_cases = header.index('GSS_NM'), header.index('TotalCases')
+            async for row in cr:
+                if not row:  # skip blank lines
+                    continue
 
-        self.log.debug("Fetching %s.", UK_URL)
-        async with self.http.get(UK_URL) as r:
-            t = await r.text()
-            l = t.splitlines()
+                regions[row[i_name]] = int(row[i_cases].replace(',', ''))
 
-        # GSS_CD, GSS_NM, TotalCases
-        cr = csv.DictReader(l)
-        for row in cr:
-            regions[row['GSS_NM']] = int(row['TotalCases'].replace(',', ''))
+            return regions
 
-        return regions
+        return await self._cached_fetch(UK_URL, parse)
 
     async def _get_uk_countries(self) -> dict:
         """Get UK constituent countries: WAL/SCO/ENG/NI
@@ -95,292 +289,367 @@ class DataSource:
         before being returned as a dict
         """
 
-        async def _process_uk_countries(uk_countries_data: list) -> dict:
+        def _process_uk_countries(latest: dict, i_indicator, i_value) -> dict:
             """Process to covbot format:
 
                 {Country1: {data1}, Country2: {data2}, ...}
             """
+            strptime = datetime.datetime.strptime
             # GB/UK data is processed elsewhere
             countries_data = {}
-            for country, update_time in UK_COUNTRIES.items():
-                # Filter data to country (ie Wales/Scotland/England/NI)
-                country_data = [r for r in uk_countries_data
-                                if r["Country"] == country]
-                # Find latest (= maximum) date and use that
-                maxidate = max([r["Date"] for r in country_data])
-                latest_country_data = [r for r in country_data
-                                       if r["Date"] == maxidate]
+            for country, (maxidate, latest_country_data) in latest.items():
+                update_time = UK_COUNTRIES[country]
                 latest_data_d = {}
                 # Pivot data to covbot format
                 for r in latest_country_data:
-                    latest_data_d[r["Indicator"].lower()] = int(r["Value"])
+                    latest_data_d[r[i_indicator].lower()] = int(r[i_value])
                     # Rename confirmedcases → cases
                     if "confirmedcases" in latest_data_d:
                         latest_data_d["cases"] = int(latest_data_d.pop(
                             "confirmedcases"))
-                        latest_data_d["last_update"] = datetime.datetime.\
-                            strptime(f"{maxidate} {update_time}",
-                                     "%Y-%m-%d %H%M %Z")
+                        latest_data_d["last_update"] = strptime(
+                            f"{maxidate} {update_time}", "%Y-%m-%d %H%M %Z")
                         countries_data[country] = latest_data_d
 
-            return countries_data
+                # the only percentage these figures allow
+                if "deaths" in latest_data_d and "cases" in latest_data_d:
+                    latest_data_d["per_dead"] = _percent(
+                        latest_data_d["deaths"], latest_data_d["cases"])
 
-        async with self.http.get(UK_COUNTRIES_URL) as r:
-            t = await r.text()
-            lines = t.splitlines()
-
-        cr = list(csv.DictReader(lines))
+            return countries_data
 
-        uk_country_data = await _process_uk_countries(cr)
+        async def parse(r):
+            # Date, Country, Indicator, Value
+            header, cr = await _csv_header_and_rows(r)
+            i_date, i_country, i_indicator, i_value = (
+                header.index(f) for f in ('Date', 'Country', 'Indicator', 'Value'))
+            latest = await _latest_uk_rows(cr, i_date, i_country)
+            return _process_uk_countries(latest, i_indicator, i_value)
 
-        return uk_country_data
+        return await self._cached_fetch(UK_COUNTRIES_URL, parse)
 
     async def _get_uk_regions(self) -> dict:
         """Return dict of UK region data"""
-        async def _process_uk_regions(regions_data: list) -> dict:
-            """Filter region data and process to covbot format"""
+        def _process_uk_regions(latest: dict, i_area, i_cases) -> dict:
+            """Process region data to covbot format"""
+            strptime = datetime.datetime.strptime
             uk_region_data = {}
 
-            for country in UK_COUNTRIES.keys():
-                country_regions = [r for r in regions_data if r["Country"] == country]
-                # Get latest data
-                maxidate = max([r["Date"] for r in country_regions])
-                region_data = [r for r in country_regions if r["Date"] == maxidate]
+            for country, (maxidate, region_data) in latest.items():
+                last_update = strptime(f"{maxidate} {UK_COUNTRIES[country]}",
+                                       "%Y-%m-%d %H%M %Z")
                 for r in region_data:
                     # Fix for GJNH data 2020-04-22 (blank)
-                    if r["TotalCases"] == '':
-                        r["TotalCases"] = 0
-                    uk_region_data[r["Area"]] = {
-                        "cases": int(r["TotalCases"]), "last_update":
-                        datetime.datetime.strptime(
-                            f"{maxidate} {UK_COUNTRIES[country]}",
-                            "%Y-%m-%d %H%M %Z")}
+                    cases = r[i_cases]
+                    uk_region_data[r[i_area]] = {
+                        "cases": 0 if cases == '' else int(cases),
+                        "last_update": last_update}
 
             return uk_region_data
 
-        async with self.http.get(UK_REGIONS_URL) as r:
-            t = await r.text()
-            lines = t.splitlines()
+        async def parse(r):
+            # Date, Country, Area, TotalCases
+            header, cr = await _csv_header_and_rows(r)
+            i_date, i_country, i_area, i_cases = (
+                header.index(f) for f in ('Date', 'Country', 'Area', 'TotalCases'))
+            latest = await _latest_uk_rows(cr, i_date, i_country)
+            return _process_uk_regions(latest, i_area, i_cases)
 
-        cr = list(csv.DictReader(lines))
-
-        uk_region_data = await _process_uk_regions(cr)
-
-        return uk_region_data
+        return await self._cached_fetch(UK_REGIONS_URL, parse)
 
     async def _get_offloop_cases(self):
-        countries = {}
-        now = time.time() * 1000  # millis to match the data
-
-        self.log.debug("Fetching %s.", OFFLOOP_CASES_URL)
-        async with self.http.get(OFFLOOP_CASES_URL) as r:
-            t = await r.text()
-            l = t.splitlines()
-
-        # Country;Province;Confirmed;Deaths;Recovered;LastUpdated
-        cr = csv.DictReader(l, delimiter=';')
-        for row in cr:
-            country = row['Country']
-            if country in COUNTRY_RENAMES:
-                country = COUNTRY_RENAMES[country]
-
-            if not country in countries:
-                countries[country] = {'areas': {}}
+        async def parse(r):
+            countries = {}
+            # bound once for the row loop
+            intern, rename = sys.intern, COUNTRY_RENAMES.get
+            utcfromtimestamp = datetime.datetime.utcfromtimestamp
+            # LastUpdated -> datetime, shared by rows updated together
+            # rows missing a timestamp get the current time
+            last_updates = {'': utcfromtimestamp(int(time.time()))}
+
+            # Country;Province;Confirmed;Deaths;Recovered;LastUpdated
+            header, cr = await _csv_header_and_rows(r, delimiter=';')
+            i_country, i_area, i_cases, i_deaths, i_recs, i_ts = (
+                header.index(f) for f in ('Country', 'Province', 'Confirmed',
+                                          'Deaths', 'Recovered', 'LastUpdated'))
+            async for row in cr:
+                if not row:  # skip blank lines
+                    continue
+
+                country = intern(row[i_country])
+                country = rename(country, country)
+
+                c_data = countries.get(country)
+                if c_data is None:
+                    c_data = countries[country] = {'areas': {}}
 #
-            # handle missing data
-            cases = 0 if row['Confirmed'] == '' else int(row['Confirmed'])
-            deaths = 0 if row['Deaths'] == '' else int(row['Deaths'])
-            recoveries = 0 if row['Recovered'] == '' else int(row['Recovered'])
-            ts_msec = now if row['LastUpdated'] == '' else int(
-                row['LastUpdated'])
-
-            ts = ts_msec // 1000
-            last_update = datetime.datetime.utcfromtimestamp(ts)
-
-            area = row['Province']
-            # Do we have a total?
-            # area for totals can be either blank or matching the country
-            if area == '' or area.lower() == country.lower():
-                if 'totals' in countries[country]:
-                    self.log.warning('Duplicate totals for %s.', country)
-
-                d = {'cases': cases, 'deaths': deaths,
-                     'recoveries': recoveries, 'last_update': last_update}
-                # TODO take the max for each value
-                countries[country]['totals'] = d
-            else:  # or an area?
-                d = {'cases': cases, 'deaths': deaths,
-                     'recoveries': recoveries, 'last_update': last_update}
-                countries[country]['areas'][area] = d
-
-        return countries
+                # handle missing data
+                cases = 0 if row[i_cases] == '' else int(row[i_cases])
+                deaths = 0 if row[i_deaths] == '' else int(row[i_deaths])
+                recoveries = 0 if row[i_recs] == '' else int(row[i_recs])
+                ts = row[i_ts]
+                last_update = last_updates.get(ts)
+                if last_update is None:  # timestamps are in millis
+                    last_update = utcfromtimestamp(int(ts) // 1000)
+                    last_updates[ts] = last_update
+
+                d = _detailed_record(cases, deaths, recoveries, last_update)
+
+                area = intern(row[i_area])
+                # Do we have a total?
+                # area for totals can be either blank or matching the country
+                if area == '' or area.lower() == country.lower():
+                    if 'totals' in c_data:
+                        self.log.warning('Duplicate totals for %s.', country)
+
+                    # TODO take the max for each value
+                    c_data['totals'] = d
+                else:  # or an area?
+                    c_data['areas'][area] = d
+
+            return countries
+
+        return await self._cached_fetch(OFFLOOP_CASES_URL, parse)
 
     async def _get_finland(self):
-        districts = {}
-
-        self.log.debug("Fetching %s.", UK_URL)
-        async with self.http.get(FINLAND_URL) as r:
+        async def parse(r):
+            districts = {}
             j = await r.json()
 
-        for case in j['confirmed']:
-            d = case['healthCareDistrict']
-            if d == None or d == '': # skip missing data
-                continue
-
-            if d not in districts:
-                districts[d] = 1
-            else:
-                districts[d] += 1
-
-        return districts
-
-    def _update_index(self):
-        # create a new index
-        d = '/tmp/covbotindex'
-        self.log.debug('Updating index in %s.', d)
-        if not os.path.exists(d):
-            os.mkdir(d)
+            for case in j['confirmed']:
+                d = case['healthCareDistrict']
+                if d == None or d == '': # skip missing data
+                    continue
 
-        self.index = create_in(d, SCHEMA)
-        idx_w = self.index.writer()
-
-        # add all the documents
-        for c, c_data in self.cases.items():
-            # TODO should this be conditional on a record existing?
-            idx_w.add_document(country=c, location=c)
+                if d not in districts:
+                    districts[d] = 1
+                else:
+                    districts[d] += 1
+
+            return districts
+
+        return await self._cached_fetch(FINLAND_URL, parse)
+
+    def _build_index(self, cases):
+        """Build the lookup tables for cases, to be published by update()."""
+        # Exact matches, added from the lowest priority up so that a
+        # country code beats a country name, which beats areas.
+        exact = {}
+        for c, c_data in cases.items():
+            for a, d in c_data['areas'].items():
+                exact.setdefault(a.lower(), []).append((f'{a}, {c}', d))
+
+        for c, c_data in cases.items():
+            if 'totals' in c_data:
+                exact[c.lower()] = [(c, c_data['totals'])]
+
+        for cc, c in COUNTRY_CODES.items():
+            if c in cases and 'totals' in cases[c]:
+                exact[cc.lower()] = [(c, cases[c]['totals'])]
+
+        # Every suffix of every lowercased location, sorted so that the
+        # locations containing a query are those of the run of suffixes
+        # starting with it.
+        locations = {}
+        for c, c_data in cases.items():
+            if 'totals' in c_data:
+                locations[c] = (c, None)
             for a in c_data['areas']:
-                l = f'{a}, {c}'
-                idx_w.add_document(country=c, area=a, location=l)
-
-        idx_w.commit()
+                locations[f'{a}, {c}'] = (c, a)
+
+        # Only case numbers move between most refreshes.
+        if locations == self._locations:
+            self.log.debug('Locations unchanged, keeping the index.')
+            return exact, self._locations, self._suffixes
+
+        # Patch a copy, the current table may be in use. The kept suffixes
+        # are still in order, so the sort only has to order the new ones
+        # and merge the two runs.
+        old = self._locations
+        added = [l for l in locations if l not in old]
+        removed = {l for l in old if l not in locations}
+        self.log.debug('Indexing %s new and dropping %s old locations.',
+                       len(added), len(removed))
+        suffixes = [s for s in self._suffixes if s[1] not in removed]
+        suffixes.extend(s for l in added for s in _location_suffixes(l))
+        suffixes.sort()
+
+        return exact, locations, suffixes
 
     async def update(self):
         now = datetime.datetime.utcfromtimestamp(int(time.time()))
 
         self.log.info('Updating data.')
         # offloop, nhs, uk, finland = await asyncio.gather(self._get_offloop_cases(), self._get_nhs(), self._get_uk(), self._get_finland())
-        offloop, finland, uk_countries, uk_regions = await asyncio.gather(self._get_offloop_cases(), self._get_finland(), self._get_uk_countries(), self._get_uk_regions())
+        sources = await asyncio.gather(self._get_offloop_cases(), self._get_offloop_groups(), self._get_finland(), self._get_uk_countries(), self._get_uk_regions())
+        if sources == self._sources:
+            # Keep the published data, and with it the lookup cache.
+            self.log.info('Data is unchanged.')
+            return
+
+        offloop, groups, finland, uk_countries, uk_regions = sources
+
+        # Merge into copies, leaving the offloop data as fetched so that
+        # it can be reused when the next fetch finds it unchanged.
+        data = dict(offloop)
+        for c in ('Finland', 'United Kingdom'):
+            data[c] = dict(offloop[c], areas=dict(offloop[c]['areas']))
 
         # TODO take the max value
         # for area, cases in nhs.items():
-        #     offloop['United Kingdom']['areas'][area] = {
+        #     data['United Kingdom']['areas'][area] = {
         #         'cases': cases, 'last_update': now}
         # for area, cases in uk.items():
-        #     offloop['United Kingdom']['areas'][area] = {
+        #     data['United Kingdom']['areas'][area] = {
         #         'cases': cases, 'last_update': now}
+        fi_areas = data['Finland']['areas']
         for area, cases in finland.items():
-            offloop['Finland']['areas'][area] = {
-                'cases': cases, 'last_update': now}
+            fi_areas[area] = {'cases': cases, 'last_update': now}
 
-        for r, ukdata in uk_countries.items():
-            offloop['United Kingdom']['areas'][r] = ukdata
+        uk_areas = data['United Kingdom']['areas']
+        uk_areas.update(uk_countries)
+        uk_areas.update(uk_regions)
 
-        for r, regiondata in uk_regions.items():
-            offloop['United Kingdom']['areas'][r] = regiondata
-
-        self.cases = offloop
-        await asyncio.get_running_loop().run_in_executor(None, self._update_index)
+        # Sum group totals once per refresh. They are then looked up
+        # like any other country.
+        for group, members in groups.items():
+            if group in data:
+                self.log.warning('Group %s clashes with a country.', group)
+                continue
 
-    def _exact_country_code_match(self, query: str) -> list:
-        self.log.debug('Trying an exact country code match on %s.', query)
-        cc = query.upper()
+            members = (COUNTRY_RENAMES.get(m, m) for m in members)
+            totals = [data[m]['totals'] for m in members
+                      if m in data and 'totals' in data[m]]
+            if len(totals) > 0:
+                data[group] = {'areas': {}, 'totals': _sum_records(totals)}
+
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(
+            self._executor, self._build_index, data)
+
+        self._publish(data, groups, *index)
+        self._sources = sources
+        await loop.run_in_executor(
+            self._executor, self._save_snapshot, (data, groups, *index))
+
+    def _publish(self, cases, groups, exact, locations, suffixes):
+        # Everything is set together, with no awaits in between, so
+        # lookups never mix new data with old tables.
+        self.cases, self.groups = cases, groups
+        self._exact, self._locations, self._suffixes = exact, locations, suffixes
+        self._lookups = collections.OrderedDict()
+
+    def _save_snapshot(self, snapshot):
+        self.log.debug('Saving snapshot to %s.', SNAPSHOT_PATH)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(SNAPSHOT_PATH))
+        except OSError:
+            self.log.warning('Failed to save snapshot to %s.',
+                             SNAPSHOT_PATH, exc_info=True)
+            return
+
+        # write aside and rename so a crash never leaves half a snapshot
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((SNAPSHOT_VERSION, snapshot), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, SNAPSHOT_PATH)
+        except OSError:
+            self.log.warning('Failed to save snapshot to %s.',
+                             SNAPSHOT_PATH, exc_info=True)
+            os.unlink(tmp)
+
+    def _load_snapshot(self):
+        try:
+            with open(SNAPSHOT_PATH, 'rb') as f:
+                # only trust a snapshot nobody else could have written
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.getuid() or st.st_mode & 0o022:
+                    self.log.warning('Ignoring untrusted snapshot %s.',
+                                     SNAPSHOT_PATH)
+                    return None
 
-        # TODO generalise.
-        # Handle UK alias.
-        if cc == 'UK':
-            cc = 'GB'
+                version, snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return None
 
-        c = pycountry.countries.get(
-            alpha_2=cc) or pycountry.countries.get(alpha_3=cc)
-        if c != None:
-            self.log.debug('Country code %s is %s.', cc, c.name)
+        if version != SNAPSHOT_VERSION:
+            self.log.info('Ignoring snapshot %s from version %s.',
+                          SNAPSHOT_PATH, version)
+            return None
 
-            if c.name not in self.cases:
-                self.log.warn('No data for %s.', c.name)
-                return None
+        return st.st_mtime, snapshot
 
-            d = self.cases[c.name]
+    async def load(self):
+        """Serve the data saved by the last update until the next one.
 
-            if not 'totals' in d:
-                self.log.debug('No totals found for %s.', c.name)
+        Returns how many seconds old the loaded data is, or None if
+        there was nothing to load.
+        """
+        try:
+            loaded = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._load_snapshot)
+            if loaded is None:
                 return None
 
-            return [(c.name, d['totals'])]
-
-        return None
-
-    def _exact_country_match(self, query: str) -> list:
-        self.log.debug('Trying an exact country match on %s.', query)
-        for country in self.cases:
-            if country.lower() == query.lower():
-                self.log.debug('Got an exact country match on %s.', query)
-
-                if 'totals' not in self.cases[country]:
-                    self.log.debug('No totals found for %s.', country)
-                    return None
-
-                return [(country, self.cases[country]['totals'])]
-
-        return None
-
-    def _exact_region_match(self, query: str) -> list:
-        self.log.debug('Trying an exact region match on %s.', query)
-        regions = []
-        for country, data in self.cases.items():
-            for area, data in data['areas'].items():
-                if area.lower() == query.lower():
-                    regions.append((f'{area}, {country}', data))
+            saved_at, snapshot = loaded
+            self._publish(*snapshot)
+        except Exception:
+            self.log.warning('Failed to load snapshot from %s.',
+                             SNAPSHOT_PATH, exc_info=True)
+            return None
 
-        if len(regions) > 0:
-            self.log.debug(
-                'Got exact region matches on %s: %s.', query, regions)
-
-        return regions
+        self.log.info('Loaded snapshot from %s.', SNAPSHOT_PATH)
+        return max(0, time.time() - saved_at)
 
     def _wildcard_location_match(self, query: str) -> list:
         self.log.debug('Trying a wildcard location match on %s.', query)
-        with self.index.searcher() as s:
-            qs = f'*{query}*'
-            q = QueryParser("location", SCHEMA).parse(qs)
-            matches = s.search(q, limit=None)
+        suffixes = self._suffixes
 
-            locs = []
-            for m in matches:
-                c, l = m['country'], m['location']
+        found = set()
+        i = bisect.bisect_left(suffixes, (query,))
+        while i < len(suffixes) and suffixes[i][0].startswith(query):
+            found.add(suffixes[i][1])
+            i += 1
 
-                if 'area' in m:
-                    d = self.cases[c]['areas'][m['area']]
-                else:
-                    d = self.cases[c]['totals']
+        locs = []
+        for l in sorted(found):
+            c, a = self._locations[l]
+
+            if a is not None:
+                d = self.cases[c]['areas'][a]
+            else:
+                d = self.cases[c]['totals']
 
-                locs.append((l, d))
+            locs.append((l, d))
 
-            if len(locs) > 0:
-                self.log.debug(
-                    'Found wildcard location matches on %s: %s.', query, locs)
+        if len(locs) > 0:
+            self.log.debug(
+                'Found wildcard location matches on %s: %s.', query, locs)
 
-            return locs
+        return locs
 
     def get(self, query: str) -> list:
         self.log.info('Looking up data for %s.', query)
+        # the matchers below all work on the normalised query
+        query = query.strip().lower()
 
-        m = self._exact_country_code_match(query)
-        if m != None:
-            return m
+        if query in self._lookups:
+            self.log.debug('Found cached matches for %s.', query)
+            self._lookups.move_to_end(query)
+            return self._lookups[query]
 
-        m = self._exact_country_match(query)
+        m = self._exact.get(query)
         if m != None:
-            return m
+            self.log.debug('Got exact matches on %s: %s.', query, m)
+        else:
+            m = self._wildcard_location_match(query)
 
-        areas = self._exact_region_match(query)
-        if len(areas) > 0:
-            return areas
-
-        locs = self._wildcard_location_match(query)
-        if len(locs) > 0:
-            return locs
+        self._lookups[query] = m
+        if len(self._lookups) > LOOKUP_CACHE_SIZE:
+            self._lookups.popitem(last=False)
 
-        return []
+        return m
 
     def get_mult(self, *queries: list) -> list:
         return [self.get(q) for q in queries]